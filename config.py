@@ -40,6 +40,12 @@ DEFAULT_UPSTREAM_URL = (
 )
 # (可选) 如果您使用自定义的 AI 网关，请设置此 URL，否则请保持为 None
 AI_GATEWAY_URL = None
+# 上游请求的超时设置 (秒)，避免卡住的连接无限期占用工作线程
+UPSTREAM_CONNECT_TIMEOUT_SECONDS = 10  # 建立连接的超时
+UPSTREAM_READ_TIMEOUT_SECONDS = 300  # 两次收到数据之间的最长等待，需覆盖长时间的生成和流式输出
+# 上游 HTTP 连接池设置，复用 keep-alive 连接以省去重复的 TCP/TLS 握手
+UPSTREAM_POOL_CONNECTIONS = 50  # 缓存的主机连接池数量
+UPSTREAM_POOL_MAXSIZE = 200  # 每个主机连接池保留的最大连接数，应不小于并发请求数
 
 # --- 熔断机制配置 ---
 # 当状态为 200 的可用密钥数量低于此值时，将完全开启熔断，大概率拒绝所有新请求
@@ -47,8 +53,14 @@ KEY_AVAILABILITY_THRESHOLD_LOW = 30
 # 当状态为 200 的可用密钥数量高于此值时，将关闭熔断，接受所有新请求
 KEY_AVAILABILITY_THRESHOLD_HIGH = 50
 # 当可用密钥数在 LOW 和 HIGH 之间时，用于计算拒绝概率的公式
-# successful_key_count 是当前可用密钥数
+# successful_key_count 是当前可用密钥数，公式中可使用 min、max、abs、round
 KEY_REJECTION_PROBABILITY_FORMULA = "(-0.05 * successful_key_count) + 2.5"
+# 可用密钥数量等统计结果的缓存时长 (秒)，避免每个请求都查询一次数据库
+KEY_STATS_CACHE_TTL_SECONDS = 10
+# 每个模型在内存中缓存的状态为 200 的候选密钥数量，请求直接从中随机挑选密钥
+KEY_CANDIDATE_CACHE_SIZE = 100
+# 候选密钥缓存的刷新间隔 (秒)
+KEY_CANDIDATE_CACHE_TTL_SECONDS = 2
 
 # --- 后台任务调度间隔 (单位: 秒) ---
 KEY_SYNC_INTERVAL_SECONDS = 300  # 从文件同步密钥到数据库的间隔
@@ -56,6 +68,14 @@ KEY_TESTER_INTERVAL_SECONDS = 300  # 运行密钥测试器的间隔
 KEY_STATUS_PRINTER_INTERVAL_SECONDS = 1800  # 将密钥状态报告写入文件的间隔
 LOG_CLEANER_INTERVAL_SECONDS = 3600  # 清理旧日志的间隔
 
+# --- 请求日志设置 ---
+# 请求日志先进入内存队列，由后台线程批量写入数据库
+LOG_WRITER_BATCH_SIZE = 500  # 单次批量写入的最大日志条数
+LOG_WRITER_FLUSH_INTERVAL_SECONDS = 0.2  # 收集一批日志的最长等待时间 (秒)
+LOG_QUEUE_MAX_SIZE = 10000  # 内存队列中最多积压的日志条数，写满后丢弃最旧的日志
+LOG_RETENTION_DAYS = 7  # 请求日志保留的天数，更早的日志会被清理
+LOG_CLEANER_BATCH_SIZE = 10000  # 清理日志时每个事务最多删除的条数
+
 # --- 密钥健康检查配置 ---
 # 密钥测试返回 200 (成功) 后，多少小时后再次测试
 TEST_INTERVAL_200_STATUS_HOURS = 12
@@ -67,6 +87,12 @@ TEST_INTERVAL_4XX_STATUS_DAYS = 1
 TEST_INTERVAL_5XX_STATUS_MINUTES = 10
 # 密钥测试器单次运行时处理的最大密钥数量 (当前实现会测试所有需要测试的密钥)
 KEY_TESTER_BATCH_LIMIT = 100
+# 密钥测试器并发测试的最大线程数
+KEY_TESTER_MAX_WORKERS = 32
+# 密钥测试结果每累计多少条在一个事务中写入数据库
+KEY_TESTER_WRITE_BATCH_SIZE = 200
+# 单次密钥测试请求的超时 (秒)
+KEY_TESTER_REQUEST_TIMEOUT_SECONDS = 30
 # 用于测试密钥有效性的 API 端点
 KEY_TESTER_DEFAULT_TEST_URL = "https://generativelanguage.googleapis.com/v1beta/models/{model_name}:generateContent"
 
@@ -75,12 +101,16 @@ STATUS_FILE_PATH = "./status.txt"  # 状态报告文件的路径
 MAX_STATUS_FILE_SIZE_MB = 1  # 状态报告文件的最大体积(MB)，超过后会自动清空
 
 # --- IP 速率限制设置 (仅对未使用 AUTH_KEY 的请求生效) ---
+# 以下请求数限制由每个 worker 进程各自计数，多进程部署时一个 IP 最多可达
+# 限制值 × worker 数；封禁记录在数据库中，对所有 worker 生效
 # 单个 IP 每分钟允许的最大请求数
 RATE_LIMITER_TPM_LIMIT = 40
 # 单个 IP 每小时请求数超过此值，将被永久封禁
 RATE_LIMITER_BAN_LIMIT = 3600
 # 临时封禁的时长 (秒)，当前未使用，因为封禁是永久的
 RATE_LIMITER_BAN_DURATION_SECONDS = 3600
+# 封禁 IP 列表在内存中的缓存时长 (秒)
+BANNED_IP_CACHE_TTL_SECONDS = 60
 
 # --- 网络代理设置 ---
 # 为所有出站请求（到 Google API）配置的代理
@@ -1,476 +1,830 @@
+import atexit
+import os
+import queue
 import sqlite3
 import random
+import threading
+import time
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 import config
 
 DB_FILE = config.DATABASE_FILE
 
-
-def get_db_connection():
-    """Establishes a connection to the SQLite database."""
-    try:
-        conn = sqlite3.connect(DB_FILE, check_same_thread=False)
+# PRAGMAs applied once to every new pooled connection; they persist for the
+# lifetime of the connection, so pooled callers get them for free.
+CONNECTION_PRAGMAS = (
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA journal_size_limit=6144000",
+    "PRAGMA cache_size=-32000",
+    "PRAGMA busy_timeout=5000",
+)
+
+
+class SQLiteConnectionPool:
+    """A bounded, thread-safe pool of reusable SQLite connections."""
+
+    def __init__(self, db_file, max_connections=8, timeout=30):
+        self.db_file = db_file
+        self.max_connections = max_connections
+        self.timeout = timeout
+        # LIFO, so the most recently used connection (with the warmest page
+        # cache) is handed out first and surplus connections stay idle
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+
+    def _create_connection(self):
+        conn = sqlite3.connect(self.db_file, check_same_thread=False)
         conn.row_factory = sqlite3.Row
+        for pragma in CONNECTION_PRAGMAS:
+            conn.execute(pragma)
         return conn
-    except sqlite3.Error as e:
-        print(f"Database connection failed: {e}")
-        return None
 
+    def acquire(self):
+        """Returns an idle connection, opening a new one while below the limit."""
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            can_create = self._created < self.max_connections
+            if can_create:
+                self._created += 1
+        if can_create:
+            try:
+                return self._create_connection()
+            except sqlite3.Error:
+                with self._lock:
+                    self._created -= 1
+                raise
+
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise sqlite3.OperationalError(
+                f"No database connection available after {self.timeout}s"
+            )
+
+    def release(self, conn):
+        """Hands a connection back to the pool, discarding any open transaction."""
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            conn.close()
+            with self._lock:
+                self._created -= 1
+            return
+        self._idle.put(conn)
+
+    def close_all(self):
+        """Closes every idle connection; connections still in use are left alone."""
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._created -= 1
+
+    @contextmanager
+    def connection(self):
+        """Context manager that acquires a connection and always releases it."""
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+
+_POOL = SQLiteConnectionPool(
+    DB_FILE, max_connections=min(32, (os.cpu_count() or 1) * 4)
+)
+# SQLite allows one writer at a time, so writes within a process share a
+# single connection and queue for it here. Each process (every gunicorn
+# worker and the background services process) has its own writer, so writes
+# from different processes still wait for each other inside busy_timeout.
+_WRITE_POOL = SQLiteConnectionPool(DB_FILE, max_connections=1)
+# Close pooled connections on shutdown so the WAL is checkpointed cleanly
+atexit.register(_POOL.close_all)
+atexit.register(_WRITE_POOL.close_all)
+
+
+# Short-lived cache for aggregate stats read on every request: {key: (expires_at, value)}
+_stats_cache = {}
+_stats_cache_lock = threading.Lock()
+
+
+def _get_cached_stat(cache_key):
+    """Returns a cached stat value, or None if it is missing or expired."""
+    with _stats_cache_lock:
+        entry = _stats_cache.get(cache_key)
+    if entry and entry[0] > time.monotonic():
+        return entry[1]
+    return None
+
+
+def _set_cached_stat(cache_key, value, ttl_seconds=None):
+    if ttl_seconds is None:
+        ttl_seconds = config.KEY_STATS_CACHE_TTL_SECONDS
+    expires_at = time.monotonic() + ttl_seconds
+    with _stats_cache_lock:
+        _stats_cache[cache_key] = (expires_at, value)
+
+
+def _invalidate_cached_stat(cache_key):
+    with _stats_cache_lock:
+        _stats_cache.pop(cache_key, None)
+
+
+@contextmanager
+def db_session(write=False):
+    """
+    Context manager yielding a pooled connection that is always released.
+    Pass write=True for sessions that modify the database; they are served
+    one at a time by the dedicated writer connection.
+    Errors acquiring a connection propagate as sqlite3.Error.
+    """
+    pool = _WRITE_POOL if write else _POOL
+    with pool.connection() as conn:
+        yield conn
 
-def calculate_next_test_time(status_code):
-    """Calculates the next test time based on the HTTP status code."""
-    now = datetime.utcnow()
-    if status_code == 200:
-        return now + timedelta(hours=config.TEST_INTERVAL_200_STATUS_HOURS)
-    elif status_code == 403:
-        return now + timedelta(days=config.TEST_INTERVAL_403_STATUS_DAYS)
-    elif 400 <= status_code < 500:
-        return now + timedelta(days=config.TEST_INTERVAL_4XX_STATUS_DAYS)
-    elif 500 <= status_code < 600:
-        return now + timedelta(minutes=config.TEST_INTERVAL_5XX_STATUS_MINUTES)
-    else:
-        return now + timedelta(days=1)  # Default for other errors
+
+# Seconds until the next key test, by exact status code and by status class
+_NEXT_TEST_DELAYS_BY_STATUS = {
+    200: config.TEST_INTERVAL_200_STATUS_HOURS * 3600,
+    403: config.TEST_INTERVAL_403_STATUS_DAYS * 86400,
+}
+_NEXT_TEST_DELAYS_BY_CLASS = {
+    4: config.TEST_INTERVAL_4XX_STATUS_DAYS * 86400,
+    5: config.TEST_INTERVAL_5XX_STATUS_MINUTES * 60,
+}
+_DEFAULT_NEXT_TEST_DELAY = 86400  # Default for other errors
+
+
+def calculate_next_test_time(status_code, now=None):
+    """
+    Calculates the next test time based on the HTTP status code.
+    Times are UNIX epoch seconds; `now` defaults to the current time.
+    """
+    if now is None:
+        now = int(time.time())
+    delay = _NEXT_TEST_DELAYS_BY_STATUS.get(status_code)
+    if delay is None:
+        delay = _NEXT_TEST_DELAYS_BY_CLASS.get(
+            status_code // 100, _DEFAULT_NEXT_TEST_DELAY
+        )
+    return now + delay
 
 
 def initialize_database():
     """Initializes the database by creating the necessary tables if they don't exist."""
-    conn = get_db_connection()
-    if conn is None:
-        return
-
     try:
-        with conn:
-            # Create api_keys table
-            conn.execute("""
-                CREATE TABLE IF NOT EXISTS api_keys (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    key_value TEXT UNIQUE NOT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                );
-            """)
+        with db_session(write=True) as conn:
+            # WAL is a persistent property of the database file, so it only needs
+            # to be switched on once; readers then no longer block on writers.
+            conn.execute("PRAGMA journal_mode=WAL")
+
+            with conn:
+                # Create api_keys table
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS api_keys (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        key_value TEXT UNIQUE NOT NULL,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    );
+                """)
+
+                # Create key_model_status table
+                # last_tested, next_test_time and updated_at are UNIX epoch seconds
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS key_model_status (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        key_id INTEGER NOT NULL,
+                        model_name TEXT NOT NULL,
+                        last_tested INTEGER,
+                        next_test_time INTEGER NOT NULL,
+                        status_code INTEGER,
+                        test_count INTEGER DEFAULT 0,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        updated_at INTEGER DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)),
+                        UNIQUE (key_id, model_name),
+                        FOREIGN KEY (key_id) REFERENCES api_keys(id) ON DELETE CASCADE
+                    );
+                """)
+
+                # Migrate timestamps written as text by older versions to epoch seconds
+                conn.execute("""
+                    UPDATE key_model_status
+                    SET last_tested = CAST(strftime('%s', last_tested) AS INTEGER)
+                    WHERE typeof(last_tested) = 'text'
+                """)
+                conn.execute("""
+                    UPDATE key_model_status
+                    SET next_test_time = COALESCE(CAST(strftime('%s', next_test_time) AS INTEGER), 0)
+                    WHERE typeof(next_test_time) = 'text'
+                """)
+                conn.execute("""
+                    UPDATE key_model_status
+                    SET updated_at = CAST(strftime('%s', updated_at) AS INTEGER)
+                    WHERE typeof(updated_at) = 'text'
+                """)
+
+                # Create request_logs table
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS request_logs (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        key_id INTEGER REFERENCES api_keys(id),
+                        model_name TEXT NOT NULL,
+                        status_code INTEGER NOT NULL,
+                        request_path TEXT NOT NULL,
+                        response_time_ms INTEGER,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    );
+                """)
+
+                # Create banned_ips table
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS banned_ips (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        ip_address TEXT UNIQUE NOT NULL,
+                        timestamp DATETIME NOT NULL
+                    );
+                """)
+
+                # Indexes for the hot key selection, counting and log queries.
+                # (key_id, model_name) lookups are already served by the UNIQUE
+                # constraint's implicit index.
+                conn.execute(
+                    "CREATE INDEX IF NOT EXISTS idx_kms_model_status ON key_model_status(model_name, status_code)"
+                )
+                conn.execute(
+                    "CREATE INDEX IF NOT EXISTS idx_kms_next_test ON key_model_status(next_test_time)"
+                )
+                conn.execute(
+                    "CREATE INDEX IF NOT EXISTS idx_logs_created_model ON request_logs(created_at, model_name)"
+                )
+
+            # Refresh planner statistics so the indexes are actually chosen.
+            # analysis_limit makes ANALYZE sample about that many rows per index
+            # instead of scanning them all, so a large request_logs table does
+            # not hold the writer connection for long on every start.
+            conn.execute("PRAGMA analysis_limit=400")
+            conn.execute("ANALYZE")
+            print("Database tables initialized successfully.")
+    except sqlite3.Error as e:
+        print(f"Database initialization failed: {e}")
 
-            # Create key_model_status table
-            conn.execute("""
-                CREATE TABLE IF NOT EXISTS key_model_status (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    key_id INTEGER NOT NULL,
-                    model_name TEXT NOT NULL,
-                    last_tested TIMESTAMP,
-                    next_test_time TIMESTAMP NOT NULL,
-                    status_code INTEGER,
-                    test_count INTEGER DEFAULT 0,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    UNIQUE (key_id, model_name),
-                    FOREIGN KEY (key_id) REFERENCES api_keys(id) ON DELETE CASCADE
-                );
-            """)
+    start_request_log_writer()
 
-            # Create request_logs table
-            conn.execute("""
-                CREATE TABLE IF NOT EXISTS request_logs (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    key_id INTEGER REFERENCES api_keys(id),
-                    model_name TEXT NOT NULL,
-                    status_code INTEGER NOT NULL,
-                    request_path TEXT NOT NULL,
-                    response_time_ms INTEGER,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                );
-            """)
 
-            # Create banned_ips table
-            conn.execute("""
-                CREATE TABLE IF NOT EXISTS banned_ips (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    ip_address TEXT UNIQUE NOT NULL,
-                    timestamp DATETIME NOT NULL
-                );
-            """)
-        print("Database tables initialized successfully.")
+def _pick_random_keys(conn, where_clause, params, limit):
+    """
+    Picks up to `limit` api keys matching `where_clause` by counting the
+    candidates and reading a slice at a random offset, instead of sorting
+    them with ORDER BY RANDOM(). The slice wraps around to the start, so
+    every candidate has the same chance of being picked. It is returned shuffled.
+    """
+    from_clause = f"""
+        FROM api_keys ak
+        JOIN key_model_status kms ON ak.id = kms.key_id
+        WHERE {where_clause}
+    """
+    count = conn.execute(f"SELECT COUNT(*) {from_clause}", params).fetchone()[0]
+    if count == 0:
+        return []
+
+    slice_sql = f"SELECT ak.id, ak.key_value {from_clause} LIMIT ? OFFSET ?"
+    offset = random.randrange(count) if count > limit else 0
+    rows = conn.execute(slice_sql, (*params, limit, offset)).fetchall()
+    if len(rows) < limit and offset > 0:
+        # Both reads run the same statement, so they see the rows in the same order
+        rows += conn.execute(
+            slice_sql, (*params, min(limit - len(rows), offset), 0)
+        ).fetchall()
+    keys = [{"id": row["id"], "key_value": row["key_value"]} for row in rows]
+    random.shuffle(keys)
+    return keys
+
+
+# Random sample of status-200 keys per model, so most requests pick a key
+# without touching the database: {model_name: (expires_at, [key dicts])}.
+# Every status-200 key is equally likely to be in a sample, so traffic is
+# spread evenly even when a model has more keys than KEY_CANDIDATE_CACHE_SIZE.
+_key_candidate_cache = {}
+_key_candidate_cache_lock = threading.Lock()
+# Models whose expired sample is being reloaded; other threads serve the old one meanwhile
+_key_candidate_reloading = set()
+
+
+def _get_key_candidates(model_name):
+    """
+    Returns the cached status-200 key sample for a model, reloading it once expired.
+    An empty list means the model has no status-200 keys; None means no sample
+    could be loaded. While one thread reloads an expired sample, the others
+    keep getting the expired one.
+    """
+    with _key_candidate_cache_lock:
+        entry = _key_candidate_cache.get(model_name)
+        if entry and entry[0] > time.monotonic():
+            return entry[1]
+        if entry and model_name in _key_candidate_reloading:
+            return entry[1]
+        _key_candidate_reloading.add(model_name)
+
+    try:
+        with db_session() as conn:
+            candidates = _pick_random_keys(
+                conn,
+                "kms.model_name = ? AND kms.status_code = 200",
+                (model_name,),
+                config.KEY_CANDIDATE_CACHE_SIZE,
+            )
+        expires_at = time.monotonic() + config.KEY_CANDIDATE_CACHE_TTL_SECONDS
+        with _key_candidate_cache_lock:
+            _key_candidate_cache[model_name] = (expires_at, candidates)
+        return candidates
     except sqlite3.Error as e:
-        print(f"Database initialization failed: {e}")
+        print(f"Failed to load key candidates for model '{model_name}': {e}")
+        return None
     finally:
-        if conn:
-            conn.close()
+        with _key_candidate_cache_lock:
+            _key_candidate_reloading.discard(model_name)
 
 
-def get_available_key_from_db(model_name):
+def _drop_key_candidate(model_name, key_id):
+    """Removes a key that just failed from the model's cached sample."""
+    with _key_candidate_cache_lock:
+        entry = _key_candidate_cache.get(model_name)
+        if entry:
+            candidates = [key for key in entry[1] if key["id"] != key_id]
+            # A sample emptied by failures says nothing about the keys left
+            # outside it, so expire it rather than report no status-200 keys
+            expires_at = entry[0] if candidates or not entry[1] else 0
+            _key_candidate_cache[model_name] = (expires_at, candidates)
+
+
+def get_available_keys_from_db(model_name, limit=32):
     """
-    Retrieves an available API key for the specified model from the database.
+    Retrieves up to `limit` distinct API keys for the specified model, in random order.
     Prioritizes keys with status 200, then untested keys.
+    Status-200 keys come from a sample cached for KEY_CANDIDATE_CACHE_TTL_SECONDS.
     """
-    conn = get_db_connection()
-    if conn is None:
-        return None
+    candidates = _get_key_candidates(model_name)
+    if candidates:
+        return random.sample(candidates, min(limit, len(candidates)))
 
     try:
-        # First, try to get a key with status 200
-        cursor = conn.execute(
-            """
-            SELECT ak.id, ak.key_value
-            FROM api_keys ak
-            JOIN key_model_status kms ON ak.id = kms.key_id
-            WHERE kms.model_name = ? AND kms.status_code = 200
-            ORDER BY RANDOM()
-            LIMIT 1
-            """,
-            (model_name,),
-        )
-        key = cursor.fetchone()
-        if key:
-            return {"id": key["id"], "key_value": key["key_value"]}
-
-        # If no 200 key, try to get an random key
-        print("No available key with status 200 found. Looking for random keys...")
-        cursor = conn.execute(
-            """
-            SELECT ak.id, ak.key_value
-            FROM api_keys ak
-            JOIN key_model_status kms ON ak.id = kms.key_id
-            WHERE kms.model_name = ?
-            ORDER BY RANDOM()
-            LIMIT 1
-            """,
-            (model_name,),
-        )
-        key = cursor.fetchone()
-        if key:
-            return {"id": key["id"], "key_value": key["key_value"]}
-
-        return None  # No suitable key found
+        with db_session() as conn:
+            if candidates is None:
+                # The sample could not be loaded, so look for status-200 keys directly
+                keys = _pick_random_keys(
+                    conn,
+                    "kms.model_name = ? AND kms.status_code = 200",
+                    (model_name,),
+                    limit,
+                )
+                if keys:
+                    return keys
+
+            # If no 200 key, fall back to random keys
+            print("No available key with status 200 found. Looking for random keys...")
+            return _pick_random_keys(conn, "kms.model_name = ?", (model_name,), limit)
     except sqlite3.Error as e:
-        print(f"Failed to get available key: {e}")
-        return None
-    finally:
-        if conn:
-            conn.close()
+        print(f"Failed to get available keys: {e}")
+        return []
+
+
+def get_available_key_from_db(model_name):
+    """Retrieves one available API key for the specified model, or None."""
+    keys = get_available_keys_from_db(model_name, limit=1)
+    return keys[0] if keys else None
+
+
+_UPDATE_KEY_STATUS_SQL = """
+    UPDATE key_model_status
+    SET status_code = ?, test_count = test_count + 1, last_tested = ?, next_test_time = ?, updated_at = ?
+    WHERE key_id = ? AND model_name = ?
+"""
 
 
 def update_key_status_in_db(key_id, model_name, status_code, source='unknown'):
     """Updates the status of a key for a specific model in the database."""
-    conn = get_db_connection()
-    if conn is None:
-        return
-
-    now = datetime.utcnow()
-    now_str = now.strftime('%Y-%m-%d %H:%M:%S')
+    now = int(time.time())
 
     try:
-        with conn:
-            if status_code == 200:
-                next_test_time = calculate_next_test_time(status_code)
+        with db_session(write=True) as conn, conn:
+            if status_code != 200 and source == 'proxy_service':
+                # A failure seen by the proxy brings the next test forward to
+                # at most 5 minutes from now, but never postpones an earlier one.
+                # Folding the read into the UPDATE saves a round trip and keeps
+                # the read-modify-write atomic.
+                conn.execute(
+                    """
+                    UPDATE key_model_status
+                    SET status_code = ?, test_count = test_count + 1, last_tested = ?, updated_at = ?,
+                        next_test_time = CASE
+                            WHEN next_test_time IS NULL THEN ?
+                            WHEN next_test_time - ? > 300 THEN ? + 300
+                            ELSE next_test_time
+                        END
+                    WHERE key_id = ? AND model_name = ?
+                    """,
+                    (
+                        status_code,
+                        now,
+                        now,
+                        calculate_next_test_time(status_code, now),
+                        now,
+                        now,
+                        key_id,
+                        model_name,
+                    ),
+                )
             else:
-                if source == 'proxy_service':
-                    cursor = conn.execute(
-                        "SELECT next_test_time FROM key_model_status WHERE key_id = ? AND model_name = ?",
-                        (key_id, model_name),
-                    )
-                    current_status = cursor.fetchone()
-                    
-                    if current_status and current_status["next_test_time"]:
-                        try:
-                            current_next_test_time = datetime.strptime(current_status["next_test_time"], '%Y-%m-%d %H:%M:%S')
-                        except (ValueError, TypeError):
-                             current_next_test_time = datetime.fromisoformat(current_status["next_test_time"])
-
-                        retry_interval_seconds = (current_next_test_time - now).total_seconds()
-
-                        if retry_interval_seconds > 300: # 5 minutes
-                            next_test_time = now + timedelta(minutes=5)
-                        else:
-                            next_test_time = current_next_test_time
-                    else:
-                        next_test_time = calculate_next_test_time(status_code)
-                else:
-                    next_test_time = calculate_next_test_time(status_code)
-            
-            next_test_str = next_test_time.strftime('%Y-%m-%d %H:%M:%S')
-
-            conn.execute(
-                """
-                UPDATE key_model_status
-                SET status_code = ?, test_count = test_count + 1, last_tested = ?, next_test_time = ?, updated_at = ?
-                WHERE key_id = ? AND model_name = ?
-                """,
-                (status_code, now_str, next_test_str, now_str, key_id, model_name),
-            )
+                conn.execute(
+                    _UPDATE_KEY_STATUS_SQL,
+                    (
+                        status_code,
+                        now,
+                        calculate_next_test_time(status_code, now),
+                        now,
+                        key_id,
+                        model_name,
+                    ),
+                )
+
+        # A key can only leave the status-200 set on a failed result, so drop
+        # it from the cached count and sample right away; newly healthy keys
+        # show up once those expire.
+        if status_code != 200:
+            _invalidate_cached_stat(("successful_key_count", model_name))
+            _drop_key_candidate(model_name, key_id)
     except Exception as e:
         print(f"Failed to update key {key_id} status for model '{model_name}': {e}")
-    finally:
-        if conn:
-            conn.close()
 
 
-def log_request_details(
-    key_id, model_name, status_code, request_path, response_time_ms
-):
-    """Logs details of each request to the request_logs table."""
-    conn = get_db_connection()
-    if conn is None:
+def update_key_statuses_in_db(results):
+    """
+    Records many key test results, given as (key_id, model_name, status_code)
+    tuples, in a single transaction.
+    """
+    if not results:
         return
+    now = int(time.time())
+    rows = [
+        (status_code, now, calculate_next_test_time(status_code, now), now, key_id, model_name)
+        for key_id, model_name, status_code in results
+    ]
 
     try:
-        with conn:
-            conn.execute(
-                """
-                INSERT INTO request_logs (key_id, model_name, status_code, request_path, response_time_ms, created_at)
-                VALUES (?, ?, ?, ?, ?, ?)
-                """,
-                (key_id, model_name, status_code, request_path, response_time_ms, datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')),
-            )
+        with db_session(write=True) as conn, conn:
+            conn.executemany(_UPDATE_KEY_STATUS_SQL, rows)
     except sqlite3.Error as e:
-        print(f"Failed to log request: {e}")
-    finally:
-        if conn:
-            conn.close()
+        print(f"Failed to update {len(rows)} key statuses: {e}")
+        return
 
+    for key_id, model_name, status_code in results:
+        if status_code != 200:
+            _invalidate_cached_stat(("successful_key_count", model_name))
+            _drop_key_candidate(model_name, key_id)
 
-def get_successful_key_count(model_name):
-    """Counts the total number of keys with status code 200 for a specific model."""
-    conn = get_db_connection()
-    if conn is None:
-        return 0
 
+# Rows waiting to be inserted into request_logs by the background writer
+_log_queue = queue.Queue(maxsize=config.LOG_QUEUE_MAX_SIZE)
+_log_writer_thread = None
+_log_writer_lock = threading.Lock()
+
+_INSERT_REQUEST_LOG_SQL = """
+    INSERT INTO request_logs (key_id, model_name, status_code, request_path, response_time_ms, created_at)
+    VALUES (?, ?, ?, ?, ?, ?)
+"""
+
+
+def log_request_details(
+    key_id, model_name, status_code, request_path, response_time_ms
+):
+    """
+    Queues the details of a request for the request_logs table.
+    Rows are written in batches by the background log writer; this never
+    blocks, and the oldest queued row is dropped if the writer falls behind.
+    """
+    if _log_writer_thread is None:
+        start_request_log_writer()
+    row = (
+        key_id,
+        model_name,
+        status_code,
+        request_path,
+        response_time_ms,
+        datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'),
+    )
     try:
-        cursor = conn.execute(
-            "SELECT COUNT(*) FROM key_model_status WHERE model_name = ? AND status_code = 200",
-            (model_name,),
+        _log_queue.put_nowait(row)
+    except queue.Full:
+        try:
+            _log_queue.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            _log_queue.put_nowait(row)
+        except queue.Full:
+            pass
+
+
+def _write_request_log_batch(batch):
+    """Inserts a batch of queued request log rows in a single transaction."""
+    try:
+        with db_session(write=True) as conn, conn:
+            conn.executemany(_INSERT_REQUEST_LOG_SQL, batch)
+    except sqlite3.Error as e:
+        print(f"Failed to log {len(batch)} requests: {e}")
+
+
+def _run_request_log_writer():
+    """Drains the log queue, writing a batch once it is full or its interval elapses."""
+    while True:
+        batch = [_log_queue.get()]
+        deadline = time.monotonic() + config.LOG_WRITER_FLUSH_INTERVAL_SECONDS
+        while len(batch) < config.LOG_WRITER_BATCH_SIZE:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(_log_queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        _write_request_log_batch(batch)
+
+
+def flush_request_logs():
+    """Writes every queued request log row immediately."""
+    batch = []
+    while True:
+        try:
+            batch.append(_log_queue.get_nowait())
+        except queue.Empty:
+            break
+        if len(batch) >= config.LOG_WRITER_BATCH_SIZE:
+            _write_request_log_batch(batch)
+            batch = []
+    if batch:
+        _write_request_log_batch(batch)
+
+
+def start_request_log_writer():
+    """Starts the background request log writer once per process."""
+    global _log_writer_thread
+    with _log_writer_lock:
+        if _log_writer_thread is not None:
+            return
+        _log_writer_thread = threading.Thread(
+            target=_run_request_log_writer, daemon=True
         )
-        count = cursor.fetchone()[0]
+        _log_writer_thread.start()
+        atexit.register(flush_request_logs)
+
+
+def get_successful_key_count(model_name):
+    """
+    Counts the total number of keys with status code 200 for a specific model.
+    The result is cached for KEY_STATS_CACHE_TTL_SECONDS.
+    """
+    cache_key = ("successful_key_count", model_name)
+    count = _get_cached_stat(cache_key)
+    if count is not None:
         return count
+
+    try:
+        with db_session() as conn:
+            cursor = conn.execute(
+                "SELECT COUNT(*) FROM key_model_status WHERE model_name = ? AND status_code = 200",
+                (model_name,),
+            )
+            count = cursor.fetchone()[0]
+            _set_cached_stat(cache_key, count)
+            return count
     except sqlite3.Error as e:
         print(
             f"Error getting successful key count for model '{model_name}' from DB: {e}"
         )
         return 0
-    finally:
-        if conn:
-            conn.close()
 
 
 def get_all_key_stats():
     """Retrieves statistics for all keys and models.
     Returns a tuple of (valid_count, invalid_count, untested_count)"""
-    conn = get_db_connection()
-    if conn is None:
-        return (0, 0, 0)
-
     try:
-        # Get count of available keys (status 200)
-        cursor = conn.execute(
-            "SELECT COUNT(DISTINCT key_id) FROM key_model_status WHERE status_code = 200"
-        )
-        valid_count = cursor.fetchone()[0]
-
-        # Get count of unavailable keys (status not 200 and not NULL)
-        cursor = conn.execute(
-            "SELECT COUNT(DISTINCT key_id) FROM key_model_status WHERE status_code != 200"
-        )
-        invalid_count = cursor.fetchone()[0]
-
-        # Get count of untested keys (status is NULL)
-        cursor = conn.execute(
-            "SELECT COUNT(DISTINCT key_id) FROM key_model_status WHERE status_code IS NULL"
-        )
-        untested_count = cursor.fetchone()[0]
+        with db_session() as conn:
+            # Count available (200), unavailable (not 200) and untested (NULL)
+            # keys in a single pass over key_model_status
+            cursor = conn.execute("""
+                SELECT
+                    COUNT(DISTINCT CASE WHEN status_code = 200 THEN key_id END),
+                    COUNT(DISTINCT CASE WHEN status_code != 200 THEN key_id END),
+                    COUNT(DISTINCT CASE WHEN status_code IS NULL THEN key_id END)
+                FROM key_model_status
+            """)
+            valid_count, invalid_count, untested_count = cursor.fetchone()
 
-        return (valid_count, invalid_count, untested_count)
+            return (valid_count, invalid_count, untested_count)
     except sqlite3.Error as e:
         print(f"Error getting all key stats: {e}")
         return (0, 0, 0)
-    finally:
-        if conn:
-            conn.close()
 
 
 def get_all_key_model_statuses():
     """
     Retrieves the status of all models for each key.
     """
-    conn = get_db_connection()
-    if conn is None:
-        return []
-
     try:
-        cursor = conn.execute("""
-            SELECT
-                ak.key_value,
-                kms.model_name,
-                kms.status_code,
-                kms.last_tested,
-                kms.next_test_time
-            FROM api_keys ak
-            JOIN key_model_status kms ON ak.id = kms.key_id
-            ORDER BY ak.key_value, kms.model_name
-        """)
-        return cursor.fetchall()
+        with db_session() as conn:
+            cursor = conn.execute("""
+                SELECT
+                    ak.key_value,
+                    kms.model_name,
+                    kms.status_code,
+                    kms.last_tested,
+                    kms.next_test_time
+                FROM api_keys ak
+                JOIN key_model_status kms ON ak.id = kms.key_id
+                ORDER BY ak.key_value, kms.model_name
+            """)
+            return cursor.fetchall()
     except sqlite3.Error as e:
         print(f"Error getting all key model statuses: {e}")
         return []
-    finally:
-        if conn:
-            conn.close()
 
 
 def get_recent_requests_count():
     """Gets the count of requests in the last 24 hours."""
-    conn = get_db_connection()
-    if conn is None:
-        return 0
-
     try:
-        twenty_four_hours_ago = (datetime.utcnow() - timedelta(hours=24)).strftime('%Y-%m-%d %H:%M:%S')
-        cursor = conn.execute(
-            "SELECT COUNT(*) FROM request_logs WHERE created_at >= ?",
-            (twenty_four_hours_ago,),
-        )
-        count = cursor.fetchone()[0]
-        return count
+        with db_session() as conn:
+            twenty_four_hours_ago = (datetime.utcnow() - timedelta(hours=24)).strftime('%Y-%m-%d %H:%M:%S')
+            cursor = conn.execute(
+                "SELECT COUNT(*) FROM request_logs WHERE created_at >= ?",
+                (twenty_four_hours_ago,),
+            )
+            count = cursor.fetchone()[0]
+            return count
     except sqlite3.Error as e:
         print(f"Error getting recent requests count: {e}")
         return 0
-    finally:
-        if conn:
-            conn.close()
 
 
 def get_model_aggregated_stats():
     """
     Aggregates key stats by model and gets recent request counts.
+    The result is cached for KEY_STATS_CACHE_TTL_SECONDS.
     """
-    conn = get_db_connection()
-    if conn is None:
-        return []
+    cache_key = ("model_aggregated_stats",)
+    result = _get_cached_stat(cache_key)
+    if result is not None:
+        return result
 
     stats = {}
 
     try:
-        # Get available/unavailable key counts per model
-        cursor = conn.execute("""
-            SELECT
-                model_name,
-                SUM(CASE WHEN status_code = 200 THEN 1 ELSE 0 END) as available_keys,
-                SUM(CASE WHEN status_code != 200 THEN 1 ELSE 0 END) as unavailable_keys
-            FROM key_model_status
-            GROUP BY model_name
-        """)
-        rows = cursor.fetchall()
-        for row in rows:
-            stats[row["model_name"]] = {
-                "available_keys": row["available_keys"] or 0,
-                "unavailable_keys": row["unavailable_keys"] or 0,
-                "requests_last_30_mins": 0,
-            }
-
-        # Get request counts for the last 30 minutes per model
-        thirty_minutes_ago = (datetime.utcnow() - timedelta(minutes=30)).strftime('%Y-%m-%d %H:%M:%S')
-        cursor = conn.execute(
-            """
-            SELECT
-                model_name,
-                COUNT(*) as request_count
-            FROM request_logs
-            WHERE created_at >= ?
-            GROUP BY model_name
-        """,
-            (thirty_minutes_ago,),
-        )
-        rows = cursor.fetchall()
-        for row in rows:
-            if row["model_name"] in stats:
-                stats[row["model_name"]]["requests_last_30_mins"] = row["request_count"]
+        with db_session() as conn:
+            # Get available/unavailable key counts per model
+            cursor = conn.execute("""
+                SELECT
+                    model_name,
+                    SUM(CASE WHEN status_code = 200 THEN 1 ELSE 0 END) as available_keys,
+                    SUM(CASE WHEN status_code != 200 THEN 1 ELSE 0 END) as unavailable_keys
+                FROM key_model_status
+                GROUP BY model_name
+            """)
+            rows = cursor.fetchall()
+            for row in rows:
+                stats[row["model_name"]] = {
+                    "available_keys": row["available_keys"] or 0,
+                    "unavailable_keys": row["unavailable_keys"] or 0,
+                    "requests_last_30_mins": 0,
+                }
+
+            # Get request counts for the last 30 minutes per model
+            thirty_minutes_ago = (datetime.utcnow() - timedelta(minutes=30)).strftime('%Y-%m-%d %H:%M:%S')
+            cursor = conn.execute(
+                """
+                SELECT
+                    model_name,
+                    COUNT(*) as request_count
+                FROM request_logs
+                WHERE created_at >= ?
+                GROUP BY model_name
+            """,
+                (thirty_minutes_ago,),
+            )
+            rows = cursor.fetchall()
+            for row in rows:
+                if row["model_name"] in stats:
+                    stats[row["model_name"]]["requests_last_30_mins"] = row["request_count"]
 
-        # Convert dict to list of dicts for the final output
-        result = [{"model_name": model, **data} for model, data in stats.items()]
-        return result
+            # Convert dict to list of dicts for the final output
+            result = [{"model_name": model, **data} for model, data in stats.items()]
+            _set_cached_stat(cache_key, result)
+            return result
 
     except sqlite3.Error as e:
         print(f"Error getting model aggregated stats: {e}")
         return []
-    finally:
-        if conn:
-            conn.close()
 
 
 def cleanup_old_logs():
-    """Deletes request logs older than a specified number of days."""
-    conn = get_db_connection()
-    if conn is None:
-        return
-
+    """
+    Deletes request logs older than LOG_RETENTION_DAYS.
+    Rows are removed in batches of LOG_CLEANER_BATCH_SIZE, each in its own
+    transaction, so a large backlog never holds the write lock for long.
+    """
     try:
         threshold_date = (
-            datetime.utcnow() - timedelta(days=config.LOG_CLEANER_INTERVAL_SECONDS / 86400)
+            datetime.utcnow() - timedelta(days=config.LOG_RETENTION_DAYS)
         ).strftime('%Y-%m-%d %H:%M:%S')
-        with conn:
-            cursor = conn.execute(
-                "DELETE FROM request_logs WHERE created_at < ?", (threshold_date,)
-            )
-            print(
-                f"Deleted {cursor.rowcount} logs older than {config.LOG_CLEANER_INTERVAL_SECONDS / 86400} days."
-            )
+        deleted_count = 0
+        while True:
+            # Hand the writer connection back between batches so other writes can run
+            with db_session(write=True) as conn, conn:
+                cursor = conn.execute(
+                    """
+                    DELETE FROM request_logs WHERE id IN (
+                        SELECT id FROM request_logs WHERE created_at < ? LIMIT ?
+                    )
+                    """,
+                    (threshold_date, config.LOG_CLEANER_BATCH_SIZE),
+                )
+            deleted_count += cursor.rowcount
+            if cursor.rowcount < config.LOG_CLEANER_BATCH_SIZE:
+                break
+        print(
+            f"Deleted {deleted_count} logs older than {config.LOG_RETENTION_DAYS} days."
+        )
     except sqlite3.Error as e:
         print(f"Error cleaning up old logs: {e}")
-    finally:
-        if conn:
-            conn.close()
 
 
 def add_banned_ip(ip_address):
     """Adds a banned IP address to the database."""
-    conn = get_db_connection()
-    if conn is None:
-        return
-
     try:
-        with conn:
+        with db_session(write=True) as conn, conn:
             conn.execute(
                 "INSERT OR IGNORE INTO banned_ips (ip_address, timestamp) VALUES (?, ?)",
                 (ip_address, datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')),
             )
+        _invalidate_cached_stat(("banned_ip_set",))
     except sqlite3.Error as e:
         print(f"Failed to add banned IP {ip_address}: {e}")
-    finally:
-        if conn:
-            conn.close()
 
 
 def remove_banned_ip(ip_address):
     """Removes a banned IP address from the database."""
-    conn = get_db_connection()
-    if conn is None:
-        return
-
     try:
-        with conn:
+        with db_session(write=True) as conn, conn:
             conn.execute("DELETE FROM banned_ips WHERE ip_address = ?", (ip_address,))
+        _invalidate_cached_stat(("banned_ip_set",))
     except sqlite3.Error as e:
         print(f"Failed to remove banned IP {ip_address}: {e}")
-    finally:
-        if conn:
-            conn.close()
 
 
-def get_all_banned_ips():
-    """Retrieves all banned IPs from the database."""
-    conn = get_db_connection()
-    if conn is None:
-        return set()
+def get_all_banned_ip_set():
+    """
+    Retrieves the set of banned IP addresses, for membership checks on the
+    request path. The result is cached for BANNED_IP_CACHE_TTL_SECONDS.
+    """
+    cache_key = ("banned_ip_set",)
+    banned_ips = _get_cached_stat(cache_key)
+    if banned_ips is not None:
+        return banned_ips
 
     try:
-        cursor = conn.execute("SELECT ip_address, timestamp FROM banned_ips")
-        # Return a dictionary of {ip: timestamp}
-        return {
-            row["ip_address"]: datetime.strptime(row["timestamp"], '%Y-%m-%d %H:%M:%S')
-            for row in cursor.fetchall()
-        }
+        with db_session() as conn:
+            cursor = conn.execute("SELECT ip_address FROM banned_ips")
+            banned_ips = frozenset(row[0] for row in cursor.fetchall())
+            _set_cached_stat(cache_key, banned_ips, config.BANNED_IP_CACHE_TTL_SECONDS)
+            return banned_ips
+    except sqlite3.Error as e:
+        print(f"Failed to get banned IP set: {e}")
+        return frozenset()
+
+
+def get_all_banned_ips():
+    """Retrieves all banned IPs with their ban timestamps from the database."""
+    try:
+        with db_session() as conn:
+            cursor = conn.execute("SELECT ip_address, timestamp FROM banned_ips")
+            # Return a dictionary of {ip: timestamp}
+            return {
+                row["ip_address"]: datetime.strptime(row["timestamp"], '%Y-%m-%d %H:%M:%S')
+                for row in cursor.fetchall()
+            }
     except sqlite3.Error as e:
         print(f"Failed to get all banned IPs: {e}")
         return {}
-    finally:
-        if conn:
-            conn.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+# 文件: gunicorn_conf.py
+# 描述: 生产环境下使用 gunicorn 多进程 + 多线程运行代理服务的配置。
+# 启动: gunicorn -c gunicorn_conf.py proxy_service:app
+
+import multiprocessing
+import os
+import subprocess
+import sys
+# gunicorn treats module-level names as settings, and "config" is one of them
+import config as app_config
+
+bind = f"{app_config.APP_HOST}:{app_config.APP_PORT}"
+# 多进程 + 多线程。不使用 gevent: SQLite 调用不会让出事件循环，
+# 等待写锁时会卡住整个 worker (包括正在进行的 SSE 流)；
+# 在线程中等待只会阻塞当前请求。
+workers = multiprocessing.cpu_count() * 2 + 1
+worker_class = "gthread"
+threads = 32
+
+# 运行后台任务 (密钥同步、测试、状态打印、日志清理) 的独立进程
+_background_process = None
+
+
+def on_starting(server):
+    """
+    在 master 进程 fork 出 worker 之前调用，整个服务只调用一次。
+    后台任务在单独的 Python 进程中运行，避免每个 worker 各运行一份。
+    注意: master 中不导入 main 等应用模块，worker 只会在 fork 之后
+    加载应用代码，不会继承 master 中的数据库连接或线程。
+    """
+    global _background_process
+    _background_process = subprocess.Popen(
+        [sys.executable, "-c", "import main; main.run_background_services()"],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+    server.log.info(f"Background services started (pid {_background_process.pid})")
+
+
+def on_exit(server):
+    """gunicorn 退出时停止后台任务进程。"""
+    if _background_process is not None and _background_process.poll() is None:
+        _background_process.terminate()
+        try:
+            _background_process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            _background_process.kill()
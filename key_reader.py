@@ -2,32 +2,73 @@ import os
 import re
 
 
+# 分隔密钥的正则表达式 (空格、换行、逗号等)
+_SPLIT_RE = re.compile(r"[\s,]+")
+
+# 已读取文件的缓存: {filepath: ((mtime_ns, size), keys)}
+_file_cache = {}
+
+
+def _read_and_format_file(filepath):
+    """
+    读取单个文件中的API密钥，仅当格式化后的内容与原内容不同时才重写文件。
+    返回 (密钥列表, 是否重写了文件)。
+    """
+    with open(filepath, "r", encoding="utf-8") as f:
+        content = f.read()
+
+    # 按空格、逗号等分隔符分割，并过滤掉空的字符串
+    cleaned_keys = list(filter(None, _SPLIT_RE.split(content)))
+
+    rewritten = False
+    if cleaned_keys:
+        # 格式化内容，每个key占一行
+        formatted_content = "\n".join(cleaned_keys)
+
+        # 只有当内容改变时才写回文件
+        if formatted_content != content:
+            with open(filepath, "w", encoding="utf-8") as f:
+                f.write(formatted_content)
+            rewritten = True
+
+    return cleaned_keys, rewritten
+
+
 def read_and_format_api_keys(directory):
     """
     读取指定目录下的所有文件，提取API密钥，并对源文件进行格式化，确保每个key占一行。
+    自上次读取以来未被修改的文件直接使用缓存的结果。
     """
     all_api_keys = []
-    for filename in os.listdir(directory):
-        filepath = os.path.join(directory, filename)
-        if os.path.isfile(filepath):
-            with open(filepath, "r+", encoding="utf-8") as f:
-                content = f.read()
-                # 使用正则表达式按空格、逗号等分隔符分割
-                keys = re.split(r"[\s,]+", content)
-                # 过滤掉空的字符串
-                cleaned_keys = [key for key in keys if key]
-
-                if cleaned_keys:
-                    all_api_keys.extend(cleaned_keys)
-
-                    # 格式化内容，每个key占一行
-                    formatted_content = "\n".join(cleaned_keys)
-
-                    # 只有当内容改变时才写回文件
-                    if formatted_content != content:
-                        f.seek(0)
-                        f.write(formatted_content)
-                        f.truncate()
+    seen_paths = set()
+    # scandir 在读取目录时即带回文件类型，避免对每个条目额外调用 stat
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if not entry.is_file():
+                continue
+
+            filepath = entry.path
+            seen_paths.add(filepath)
+            st = entry.stat()
+            signature = (st.st_mtime_ns, st.st_size)
+
+            cached = _file_cache.get(filepath)
+            if cached and cached[0] == signature:
+                keys = cached[1]
+            else:
+                keys, rewritten = _read_and_format_file(filepath)
+                if rewritten:
+                    # 文件刚被我们重写，记录写入后的状态
+                    st = os.stat(filepath)
+                    signature = (st.st_mtime_ns, st.st_size)
+                # 否则使用读取前的状态: 读取后才被修改的文件在下次同步时会重新读取
+                _file_cache[filepath] = (signature, keys)
+
+            all_api_keys.extend(keys)
+
+    # 移除已被删除的文件的缓存
+    for filepath in set(_file_cache) - seen_paths:
+        del _file_cache[filepath]
 
     return all_api_keys
 
@@ -1,6 +1,5 @@
 import random
 import time
-from datetime import datetime
 import config
 import database
 from key_reader import read_and_format_api_keys
@@ -25,93 +24,93 @@ def sync_keys_to_db():
 
 def sync_api_keys_table():
     """Ensures the api_keys table is in sync with the key files."""
-    conn = database.get_db_connection()
-    if conn is None:
-        return
-
     try:
-        keys_from_files = set(read_keys())
-        
-        with conn:
-            # Get keys from DB
-            cursor = conn.execute("SELECT id, key_value FROM api_keys")
-            keys_in_db = {row['key_value']: row['id'] for row in cursor.fetchall()}
-            db_key_values = set(keys_in_db.keys())
-
-            # Add new keys to DB
-            new_keys = keys_from_files - db_key_values
-            if new_keys:
-                conn.executemany("INSERT INTO api_keys (key_value) VALUES (?)", [(k,) for k in new_keys])
-                print(f"Added {len(new_keys)} new keys to DB.")
+        keys_from_files = read_keys()
+
+        with database.db_session(write=True) as conn, conn:
+            # Take the write lock up front: upgrading a read transaction to a
+            # write one fails with SQLITE_BUSY instead of waiting for the lock
+            conn.execute("BEGIN IMMEDIATE")
+
+            # Load the keys from the files into a temp table and let SQLite
+            # compute the new and obsolete keys with indexed set operations
+            conn.execute("DROP TABLE IF EXISTS temp.key_sync_src")
+            conn.execute("CREATE TEMP TABLE key_sync_src (key_value TEXT PRIMARY KEY)")
+            conn.executemany(
+                "INSERT OR IGNORE INTO key_sync_src (key_value) VALUES (?)",
+                ((k,) for k in keys_from_files),
+            )
+
+            # Add only keys missing from api_keys, so AUTOINCREMENT ids are not burned
+            cursor = conn.execute(
+                "INSERT INTO api_keys (key_value) SELECT s.key_value FROM key_sync_src s "
+                "WHERE NOT EXISTS (SELECT 1 FROM api_keys ak WHERE ak.key_value = s.key_value)"
+            )
+            if cursor.rowcount:
+                print(f"Added {cursor.rowcount} new keys to DB.")
 
             # Remove old keys from DB
-            keys_to_remove = db_key_values - keys_from_files
-            if keys_to_remove:
-                ids_to_remove = [keys_in_db[val] for val in keys_to_remove]
-                conn.executemany("DELETE FROM api_keys WHERE id = ?", [(id,) for id in ids_to_remove])
-                print(f"Removed {len(keys_to_remove)} obsolete keys from DB.")
+            cursor = conn.execute(
+                "DELETE FROM api_keys WHERE key_value NOT IN (SELECT key_value FROM key_sync_src)"
+            )
+            if cursor.rowcount:
+                print(f"Removed {cursor.rowcount} obsolete keys from DB.")
+
+            conn.execute("DROP TABLE temp.key_sync_src")
 
     except Exception as e:
         print(f"API key sync failed: {e}")
-    finally:
-        if conn:
-            conn.close()
 
 
 def sync_key_model_status_table():
     """
     Adds or removes records in `key_model_status` to match the `SUPPORTED_MODELS` list.
     """
-    conn = database.get_db_connection()
-    if conn is None:
-        return
-
     try:
         current_supported_models = set(config.SUPPORTED_MODELS)
-        
-        with conn:
-            # Get all key IDs from the api_keys table
-            cursor = conn.execute("SELECT id FROM api_keys")
-            all_key_ids = {row['id'] for row in cursor.fetchall()}
-
-            # Get all existing key-model pairs from the database
-            cursor = conn.execute("SELECT key_id, model_name FROM key_model_status")
-            existing_db_pairs = {(row['key_id'], row['model_name']) for row in cursor.fetchall()}
-
-            # 1. Add missing key-model pairs
-            pairs_to_add = []
-            for key_id in all_key_ids:
-                for model_name in current_supported_models:
-                    if (key_id, model_name) not in existing_db_pairs:
-                        pairs_to_add.append((key_id, model_name, datetime.now().isoformat()))
-            
-            if pairs_to_add:
-                conn.executemany(
-                    "INSERT INTO key_model_status (key_id, model_name, next_test_time) VALUES (?, ?, ?)",
-                    pairs_to_add
+
+        with database.db_session(write=True) as conn, conn:
+            # 1. Add missing key-model pairs, letting SQLite find the keys
+            #    that have no status row for each supported model
+            now = int(time.time())
+            added_count = 0
+            for model_name in current_supported_models:
+                cursor = conn.execute(
+                    """
+                    INSERT INTO key_model_status (key_id, model_name, next_test_time, updated_at)
+                    SELECT ak.id, ?, ?, ?
+                    FROM api_keys ak
+                    WHERE NOT EXISTS (
+                        SELECT 1 FROM key_model_status kms
+                        WHERE kms.key_id = ak.id AND kms.model_name = ?
+                    )
+                    """,
+                    (model_name, now, now, model_name),
                 )
-                print(f"Added {len(pairs_to_add)} new key-model status records.")
-
-            # 2. Delete obsolete key-model pairs
-            pairs_to_delete = []
-            for key_id, model_name in existing_db_pairs:
-                if model_name not in current_supported_models:
-                    pairs_to_delete.append((key_id, model_name))
-            
-            if pairs_to_delete:
-                conn.executemany("DELETE FROM key_model_status WHERE key_id = ? AND model_name = ?", pairs_to_delete)
-                print(f"Deleted {len(pairs_to_delete)} obsolete key-model status records.")
+                added_count += cursor.rowcount
+
+            if added_count:
+                print(f"Added {added_count} new key-model status records.")
+
+            # 2. Delete pairs for unsupported models or for keys that no longer exist
+            placeholders = ",".join("?" * len(current_supported_models))
+            cursor = conn.execute(
+                f"""
+                DELETE FROM key_model_status
+                WHERE model_name NOT IN ({placeholders})
+                   OR key_id NOT IN (SELECT id FROM api_keys)
+                """,
+                tuple(current_supported_models),
+            )
+
+            if cursor.rowcount:
+                print(f"Deleted {cursor.rowcount} obsolete key-model status records.")
 
         print("Key-model status synchronization completed.")
     except Exception as e:
         print(f"Key-model status sync failed: {e}")
-    finally:
-        if conn:
-            conn.close()
 
 
 if __name__ == "__main__":
-    # Example usage: Run sync periodically
-    while True:
-        sync_keys_to_db()
-        time.sleep(config.KEY_SYNC_INTERVAL_SECONDS)
+    # Run a single sync; periodic runs are handled by scheduler.py
+    sync_keys_to_db()
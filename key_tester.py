@@ -1,14 +1,18 @@
 import time
 import random
-from datetime import datetime, timedelta
 import requests
 import json
-from database import get_db_connection, update_key_status_in_db
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from database import db_session, update_key_statuses_in_db
 from config import (
     SUPPORTED_MODELS,
     KEY_TESTER_BATCH_LIMIT,
     KEY_TESTER_DEFAULT_TEST_URL,
+    KEY_TESTER_REQUEST_TIMEOUT_SECONDS,
     KEY_TESTER_INTERVAL_SECONDS,
+    KEY_TESTER_MAX_WORKERS,
+    KEY_TESTER_WRITE_BATCH_SIZE,
     TEST_INTERVAL_200_STATUS_HOURS,
     TEST_INTERVAL_403_STATUS_DAYS,
     TEST_INTERVAL_4XX_STATUS_DAYS,
@@ -16,14 +20,25 @@ from config import (
     PROXY,
 )
 
+# 测试请求共享的会话，每个测试线程都能复用一条 keep-alive 连接
+_session = requests.Session()
+_session.mount(
+    "https://", HTTPAdapter(pool_maxsize=KEY_TESTER_MAX_WORKERS, max_retries=0)
+)
+
+# 每次测试发送的内容都相同，在导入时序列化一次即可
+_TEST_PAYLOAD = json.dumps(
+    {"contents": [{"parts": [{"text": "Hello, world!"}]}]}
+).encode("utf-8")
+_TEST_HEADERS_BASE = {"Content-Type": "application/json"}
+
 
 def test_key(key_value, model_name):
     """
     测试单个API密钥对指定模型的可用性。
     """
     url = KEY_TESTER_DEFAULT_TEST_URL.format(model_name=model_name)
-    headers = {"x-goog-api-key": key_value, "Content-Type": "application/json"}
-    payload = {"contents": [{"parts": [{"text": "Hello, world!"}]}]}
+    headers = {**_TEST_HEADERS_BASE, "x-goog-api-key": key_value}
     if PROXY:
         proxies = {
             "http": PROXY,
@@ -33,8 +48,12 @@ def test_key(key_value, model_name):
         proxies = None
 
     try:
-        response = requests.post(
-            url, headers=headers, data=json.dumps(payload), proxies=proxies
+        response = _session.post(
+            url,
+            headers=headers,
+            data=_TEST_PAYLOAD,
+            proxies=proxies,
+            timeout=KEY_TESTER_REQUEST_TIMEOUT_SECONDS,
         )
         return response.status_code
     except Exception as e:
@@ -44,70 +63,63 @@ def test_key(key_value, model_name):
 
 def run_key_tester():
     """
-    遍历所有密钥，并独立测试每个密钥支持的每个模型。
+    遍历所有密钥，并发测试每个密钥支持的每个模型。
     """
-    conn = get_db_connection()
-    if conn is None:
-        print("无法连接到数据库。")
-        return
-
     try:
-        # 1. 获取所有唯一的密钥
-        all_keys = conn.execute("SELECT id, key_value FROM api_keys").fetchall()
-
-        if not all_keys:
-            print("数据库中没有找到API密钥。")
-            return
-
-        print(f"开始测试 {len(all_keys)} 个密钥...")
-
-        # 2. 遍历每个密钥
-        for key in all_keys:
-            key_id = key["id"]
-            key_value = key["key_value"]
-
-            # 3. 遍历该密钥支持的所有模型
-            for model_name in SUPPORTED_MODELS:
-                # 4. 独立判断每个模型是否需要测试
-                model_status = conn.execute(
-                    """
-                    SELECT last_tested, next_test_time
-                    FROM key_model_status
-                    WHERE key_id = ? AND model_name = ?
+        with db_session() as conn:
+            # 1. 检查数据库中是否有密钥
+            key_count = conn.execute("SELECT COUNT(*) FROM api_keys").fetchone()[0]
+
+            if not key_count:
+                print("数据库中没有找到API密钥。")
+                return
+
+            # 2. 直接在 SQL 中筛选出 next_test_time 已到的 (密钥, 模型) 组合，
+            #    可走索引，无需在 Python 中逐行判断。
+            #    还没有状态记录的组合会在下次密钥同步时补齐，之后再测试。
+            model_placeholders = ",".join("?" * len(SUPPORTED_MODELS))
+            pending = conn.execute(
+                f"""
+                SELECT ak.id, ak.key_value, kms.model_name
+                FROM key_model_status kms
+                JOIN api_keys ak ON ak.id = kms.key_id
+                WHERE kms.next_test_time <= ? AND kms.model_name IN ({model_placeholders})
                 """,
-                    (key_id, model_name),
-                ).fetchone()
+                (int(time.time()), *SUPPORTED_MODELS),
+            ).fetchall()
 
-                # 如果没有状态记录，或者 next_test_time 已到，则需要测试
-                needs_test = False
-                if model_status is None:
-                    needs_test = True
-                else:
-                    next_test_time_str = model_status["next_test_time"]
-                    if (
-                        next_test_time_str is None
-                        or datetime.fromisoformat(next_test_time_str) <= datetime.now()
-                    ):
-                        needs_test = True
-
-                if needs_test:
+        print(f"开始测试 {key_count} 个密钥，共 {len(pending)} 个 (密钥, 模型) 组合需要测试...")
+
+        # 3. 并发发出测试请求，结果在当前线程中按批写回数据库
+        results = []
+        with ThreadPoolExecutor(max_workers=KEY_TESTER_MAX_WORKERS) as executor:
+            futures = {
+                executor.submit(test_key, key_value, model_name): (
+                    key_id,
+                    key_value,
+                    model_name,
+                )
+                for key_id, key_value, model_name in pending
+            }
+            for future in as_completed(futures):
+                key_id, key_value, model_name = futures[future]
+                status_code = future.result()
+                if status_code is not None:
+                    results.append((key_id, model_name, status_code))
                     print(
-                        f"  正在测试密钥 {key_value[:5]}... 在模型 {model_name} 上的状态..."
+                        f"  密钥 {key_value[:5]}... 在模型 {model_name} 上测试完成，状态码: {status_code}"
                     )
-                    status_code = test_key(key_value, model_name)
-                    if status_code is not None:
-                        update_key_status_in_db(key_id, model_name, status_code, source='key_tester')
-                        print(f"    -> 测试完成，状态码: {status_code}")
-                    else:
-                        print(f"    -> 测试失败。")
-                # else:
-                #     print(f"  密钥 {key_value[:5]}... 在模型 {model_name} 上无需测试，下次测试时间: {model_status['next_test_time']}")
+                else:
+                    print(f"  密钥 {key_value[:5]}... 在模型 {model_name} 上测试失败。")
+
+                if len(results) >= KEY_TESTER_WRITE_BATCH_SIZE:
+                    update_key_statuses_in_db(results)
+                    results = []
+
+        update_key_statuses_in_db(results)
 
     except Exception as e:
         print(f"密钥测试器运行时发生错误: {e}")
-    finally:
-        if conn:
-            conn.close()
 
 
 if __name__ == "__main__":
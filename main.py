@@ -1,21 +1,9 @@
 import threading
 import time
 import config  # 导入配置文件
-from database import (
-    initialize_database,
-    cleanup_old_logs,
-)
-from key_sync import sync_keys_to_db
+from database import initialize_database
 from key_tester import run_key_tester
-from key_status_printer import print_key_status
-from proxy_service import app
-
-
-def run_key_sync_periodically():
-    """Runs key sync in a loop."""
-    while True:
-        sync_keys_to_db()
-        time.sleep(config.KEY_SYNC_INTERVAL_SECONDS)
+from scheduler import create_scheduler
 
 
 def run_key_tester_periodically():
@@ -25,51 +13,50 @@ def run_key_tester_periodically():
         time.sleep(config.KEY_TESTER_INTERVAL_SECONDS)
 
 
-def run_key_status_printer_periodically():
-    """Runs key status printer in a loop."""
-    while True:
-        print_key_status()
-        time.sleep(config.KEY_STATUS_PRINTER_INTERVAL_SECONDS)
+def start_background_services():
+    """Starts the scheduler and key tester threads in the current process."""
+    # Key sync, status printer and log cleaner share one scheduler thread
+    scheduler = create_scheduler()
+    scheduler.start()
+    print("Scheduler thread started.")
+
+    # Key tester gets its own thread, since a run can take minutes
+    key_tester_thread = threading.Thread(
+        target=run_key_tester_periodically, daemon=True
+    )
+    key_tester_thread.start()
+    print("Key tester thread started.")
 
 
-def run_log_cleaner_periodically():
-    """Runs log cleaner in a loop."""
+def run_background_services():
+    """
+    Initializes the database and runs the background services until killed.
+    Used as the entry point of the dedicated process started by gunicorn_conf.py.
+    """
+    initialize_database()
+    start_background_services()
     while True:
-        cleanup_old_logs()
-        time.sleep(config.LOG_CLEANER_INTERVAL_SECONDS)
+        time.sleep(3600)
 
 
 if __name__ == "__main__":
+    # Imported here so the background services process does not load the app
+    from proxy_service import app
+
     # 1. Initialize database
     initialize_database()
 
-    # 2. Start key sync in a separate thread
-    key_sync_thread = threading.Thread(target=run_key_sync_periodically, daemon=True)
-    key_sync_thread.start()
-    print("Key sync thread started.")
+    # 2. Start background services
+    start_background_services()
 
-    # 3. Start key tester in a separate thread
-    key_tester_thread = threading.Thread(
-        target=run_key_tester_periodically, daemon=True
-    )
-    key_tester_thread.start()
-    print("Key tester thread started.")
-
-    # 4. Start key status printer in a separate thread
-    key_status_printer_thread = threading.Thread(
-        target=run_key_status_printer_periodically, daemon=True
-    )
-    key_status_printer_thread.start()
-    print("Key status printer thread started.")
-
-    # 5. Start log cleaner in a separate thread
-    log_cleaner_thread = threading.Thread(
-        target=run_log_cleaner_periodically, daemon=True
-    )
-    log_cleaner_thread.start()
-    print("Log cleaner thread started.")
-
-    # 6. Start the Flask proxy service
+    # 3. Start the Flask proxy service
     print("Starting proxy service...")
-    # In a real deployment, use a production-ready WSGI server
-    app.run(debug=config.DEBUG_MODE, port=config.APP_PORT, host=config.APP_HOST)
+    # Each request is served on its own thread; upstream calls are bounded by
+    # config.UPSTREAM_*_TIMEOUT_SECONDS so a stalled connection cannot pin one forever.
+    # For production, run under gunicorn instead: gunicorn -c gunicorn_conf.py proxy_service:app
+    app.run(
+        debug=config.DEBUG_MODE,
+        port=config.APP_PORT,
+        host=config.APP_HOST,
+        threaded=True,
+    )
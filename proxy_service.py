@@ -1,17 +1,19 @@
 import os
+import threading
+import time
 import traceback
 import requests
 import random
+from requests.adapters import HTTPAdapter
 from flask import Flask, request, jsonify, make_response, Response, stream_with_context
-from urllib.parse import urlparse, urlunparse, parse_qs, urlencode
-from datetime import datetime, timedelta
+from urllib.parse import unquote_plus
 import config  # 导入配置文件
 from flask_cors import CORS
 from database import (
     get_successful_key_count,
     update_key_status_in_db,
     log_request_details,
-    get_available_key_from_db,
+    get_available_keys_from_db,
 )
 from rate_limiter import rate_limiter
 
@@ -24,8 +26,43 @@ MAX_RETRIES = config.MAX_RETRIES
 SUPPORTED_MODELS = config.SUPPORTED_MODELS
 AI_GATEWAY_URL = os.environ.get("AI_GATEWAY_URL", config.AI_GATEWAY_URL)
 DEFAULT_UPSTREAM_URL = config.DEFAULT_UPSTREAM_URL
+# Gateway URL prefix, built once instead of on every request
+AI_GATEWAY_MODELS_URL = (
+    f"{AI_GATEWAY_URL}/google-ai-studio/v1beta/models/" if AI_GATEWAY_URL else None
+)
+UPSTREAM_TIMEOUT = (
+    config.UPSTREAM_CONNECT_TIMEOUT_SECONDS,
+    config.UPSTREAM_READ_TIMEOUT_SECONDS,
+)
 KEY_AVAILABILITY_THRESHOLD_LOW = config.KEY_AVAILABILITY_THRESHOLD_LOW
 KEY_AVAILABILITY_THRESHOLD_HIGH = config.KEY_AVAILABILITY_THRESHOLD_HIGH
+# 将拒绝概率公式预编译为函数，避免每个请求都重新解析和编译公式字符串
+# 公式只能使用少数数学内置函数，不能访问其他内置函数
+_REJECTION_FORMULA_GLOBALS = {
+    "__builtins__": {},
+    "min": min,
+    "max": max,
+    "abs": abs,
+    "round": round,
+}
+_rejection_probability = eval(
+    compile(
+        f"lambda successful_key_count: ({config.KEY_REJECTION_PROBABILITY_FORMULA})",
+        "<KEY_REJECTION_PROBABILITY_FORMULA>",
+        "eval",
+    ),
+    _REJECTION_FORMULA_GLOBALS,
+)
+
+# 复用上游连接的会话，所有代理请求共享同一个连接池
+_upstream_adapter = HTTPAdapter(
+    pool_connections=config.UPSTREAM_POOL_CONNECTIONS,
+    pool_maxsize=config.UPSTREAM_POOL_MAXSIZE,
+    max_retries=0,
+)
+_session = requests.Session()
+_session.mount("https://", _upstream_adapter)
+_session.mount("http://", _upstream_adapter)
 
 
 # Custom exception for SSE pre-check failure
@@ -60,33 +97,55 @@ def _validate_path(subpath):
 
 def _authenticate_request():
     """验证客户端API密钥。"""
-    if AUTH_KEY:
-        client_key = request.args.get("key")
-        header_key = request.headers.get("x-goog-api-key")
-        if client_key != AUTH_KEY and header_key != AUTH_KEY:
-            return False
-    return True
+    if not AUTH_KEY:
+        return True
+    # Check the header first; the query string only needs parsing if it is absent
+    return (
+        request.headers.get("x-goog-api-key") == AUTH_KEY
+        or request.args.get("key") == AUTH_KEY
+    )
 
 
-def _check_key_availability(model):
-    """检查针对特定模型的可用密钥数量并根据策略决定是否拒绝请求。"""
+# (model, second) -> (successful_key_count, probability_of_rejection); requests
+# for the same model within one second share a single lookup
+_availability_cache = {}
+_availability_cache_lock = threading.Lock()
+_AVAILABILITY_CACHE_MAX_ENTRIES = 256
+
+
+def _get_key_availability(model):
+    """返回模型当前的可用密钥数量和请求拒绝概率，每个模型每秒只计算一次。"""
+    cache_key = (model, int(time.time()))
+    with _availability_cache_lock:
+        cached = _availability_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
     successful_key_count = get_successful_key_count(model)
     print("Successful key", successful_key_count)
-    reject_request = False
     if successful_key_count < KEY_AVAILABILITY_THRESHOLD_LOW:
-        reject_request = True
-    elif (
-        KEY_AVAILABILITY_THRESHOLD_LOW
-        <= successful_key_count
-        < KEY_AVAILABILITY_THRESHOLD_HIGH
-    ):
+        probability_of_rejection = 1.0
+    elif successful_key_count < KEY_AVAILABILITY_THRESHOLD_HIGH:
         # This uses the formula from the config, but it's safer to keep the logic here
-        probability_of_rejection = eval(
-            config.KEY_REJECTION_PROBABILITY_FORMULA,
-            {"successful_key_count": successful_key_count},
-        )
-        if random.random() < probability_of_rejection:
-            reject_request = True
+        probability_of_rejection = _rejection_probability(successful_key_count)
+    else:
+        probability_of_rejection = 0.0
+
+    cached = (successful_key_count, probability_of_rejection)
+    with _availability_cache_lock:
+        if len(_availability_cache) >= _AVAILABILITY_CACHE_MAX_ENTRIES:
+            # Entries from earlier seconds can never be hit again
+            for stale_key in [k for k in _availability_cache if k[1] != cache_key[1]]:
+                del _availability_cache[stale_key]
+        _availability_cache[cache_key] = cached
+    return cached
+
+
+def _check_key_availability(model):
+    """检查针对特定模型的可用密钥数量并根据策略决定是否拒绝请求。"""
+    successful_key_count, probability_of_rejection = _get_key_availability(model)
+    # The coin is still flipped per request, so the rejection rate is unchanged
+    reject_request = random.random() < probability_of_rejection
 
     if reject_request:
         print(
@@ -98,20 +157,23 @@ def _check_key_availability(model):
 
 def _build_upstream_url(subpath):
     """根据配置构建上游API的URL。"""
-    upstream_url = ""
-
-    if AI_GATEWAY_URL:
-        model_path = subpath.split("/")[-1]
-        upstream_url = f"{AI_GATEWAY_URL}/google-ai-studio/v1beta/models/{model_path}"
+    if AI_GATEWAY_MODELS_URL:
+        upstream_url = AI_GATEWAY_MODELS_URL + subpath.rsplit("/", 1)[-1]
     else:
         upstream_url = f"{DEFAULT_UPSTREAM_URL}/{subpath}"
 
-    parsed_url = urlparse(request.url)
-    query_params = parse_qs(parsed_url.query)
-    query_params.pop("key", None)
-
-    if query_params:
-        upstream_url += "?" + urlencode(query_params, doseq=True)
+    # Forward the raw query string as-is, minus the client's own `key` parameter.
+    # Names are percent-decoded for the comparison, as request.args does, so an
+    # encoded name such as %6Bey cannot smuggle the gateway's AUTH_KEY upstream.
+    query_string = request.query_string.decode("utf-8", errors="replace")
+    if query_string:
+        query_params = [
+            param
+            for param in query_string.split("&")
+            if param and unquote_plus(param.split("=", 1)[0]) != "key"
+        ]
+        if query_params:
+            upstream_url += "?" + "&".join(query_params)
 
     return upstream_url
 
@@ -120,27 +182,29 @@ def _handle_sse_stream(response, response_headers):
     """处理Server-Sent Events (SSE) 流式响应，包括预检。"""
 
     def generate():
-        buffer = b""
+        buffer = bytearray()
+        scan_from = 0  # Bytes before this offset are known not to hold a delimiter
         event_count = 0
-        precheck_done = False
         buffered_events_list = []
 
         response_iterator = response.iter_content(chunk_size=8192)
 
+        # Buffer the first two events for the pre-check; the rest is streamed below
         for chunk in response_iterator:
-            buffer += chunk
-            if not precheck_done:
-                while b"\r\n\r\n" in buffer and not precheck_done:
-                    event_end_index = buffer.find(b"\r\n\r\n") + 4
-                    event = buffer[:event_end_index]
-                    buffer = buffer[event_end_index:]
-                    buffered_events_list.append(event)
-                    event_count += 1
-                    if event_count == 2:
-                        precheck_done = True
-                        break
-                if precheck_done:
+            buffer.extend(chunk)
+            while event_count < 2:
+                delimiter_index = buffer.find(b"\r\n\r\n", scan_from)
+                if delimiter_index == -1:
+                    # A delimiter may straddle the next chunk boundary
+                    scan_from = max(len(buffer) - 3, 0)
                     break
+                event_end_index = delimiter_index + 4
+                buffered_events_list.append(bytes(buffer[:event_end_index]))
+                del buffer[:event_end_index]
+                scan_from = 0
+                event_count += 1
+            if event_count == 2:
+                break
 
         # Check for finishReason if event count is low
         full_response_str = (b''.join(buffered_events_list) + buffer).decode('utf-8', errors='ignore')
@@ -155,15 +219,24 @@ def _handle_sse_stream(response, response_headers):
             yield event
 
         if buffer:
-            yield buffer
+            yield bytes(buffer)
 
         for chunk in response_iterator:
             yield chunk
 
+    def generate_and_release():
+        # Return the upstream connection to the pool even if the client disconnects
+        try:
+            yield from generate()
+        finally:
+            response.close()
+
     response_headers = {
         k: v for k, v in response_headers.items() if k.lower() != "transfer-encoding"
     }
-    return Response(stream_with_context(generate()), headers=response_headers)
+    return Response(
+        stream_with_context(generate_and_release()), headers=response_headers
+    )
 
 
 def _execute_proxy_request(subpath, key_value):
@@ -183,13 +256,14 @@ def _execute_proxy_request(subpath, key_value):
     else:
         proxy = None
 
-    response = requests.request(
+    response = _session.request(
         method=request.method,
         url=upstream_url,
         headers=new_headers,
         data=request.data,
         stream=True,
         proxies=proxy,
+        timeout=UPSTREAM_TIMEOUT,
     )
     return response
 
@@ -199,9 +273,14 @@ def _stream_response(response, response_headers, status_code):
     if "text/event-stream" in response.headers.get("Content-Type", ""):
         return _handle_sse_stream(response, response_headers)
     else:
-        full_content = b"".join(response.iter_content(chunk_size=8192))
+
+        def generate():
+            # Forward the body as it arrives, then return the connection to the pool
+            with response:
+                yield from response.iter_content(chunk_size=65536)
+
         return Response(
-            full_content,
+            stream_with_context(generate()),
             headers=response_headers,
             status=status_code,
         )
@@ -210,7 +289,8 @@ def _stream_response(response, response_headers, status_code):
 @app.route("/<path:subpath>", methods=["POST"])
 def handle_request(subpath):
     # 1. Authentication & Rate Limiting for unauthorized access
-    if not _authenticate_request():
+    is_authenticated = _authenticate_request()
+    if not is_authenticated:
         client_ip = request.remote_addr
         if not rate_limiter.check_rate_limit(client_ip):
             print(f"IP {client_ip} hit rate limit.")
@@ -222,16 +302,24 @@ def handle_request(subpath):
         return make_response(jsonify(error=error_message), status_code)
 
     # 3. Key availability check (only for unauthorized access)
-    if not _authenticate_request():
+    if not is_authenticated:
         is_available, error_message, status_code = _check_key_availability(model_name)
         if not is_available:
             return make_response(jsonify(error=error_message), status_code)
 
     used_key_ids = set()
+    # Candidate keys fetched once and consumed across retries; refetched only
+    # when exhausted, skipping keys already tried for this request
+    candidate_keys = []
 
     for retry_count in range(MAX_RETRIES):
-        key = get_available_key_from_db(model_name)
-        if key is None:
+        if not candidate_keys:
+            candidate_keys = [
+                key
+                for key in get_available_keys_from_db(model_name)
+                if key["id"] not in used_key_ids
+            ]
+        if not candidate_keys:
             if retry_count == 0:
                 # Log failure only on the first attempt to find a key
                 log_request_details(None, model_name, 503, request.path, 0)
@@ -240,18 +328,14 @@ def handle_request(subpath):
             )
             continue
 
+        key = candidate_keys.pop()
         key_id, key_value = key["id"], key["key_value"]
-
-        if key_id in used_key_ids:
-            print(f"Key {key_id} already used in this sequence, getting another.")
-            continue
         used_key_ids.add(key_id)
 
-        start_time = datetime.now()
+        start_time_ns = time.monotonic_ns()
         try:
             response = _execute_proxy_request(subpath, key_value)
-            end_time = datetime.now()
-            response_time_ms = int((end_time - start_time).total_seconds() * 1000)
+            response_time_ms = (time.monotonic_ns() - start_time_ns) // 1_000_000
             status_code = response.status_code
 
             update_key_status_in_db(
@@ -277,11 +361,11 @@ def handle_request(subpath):
                 print(
                     f"raw  response: {response.content.decode(errors='ignore')[:1000]}"
                 )  # Log first 1000 chars
+                response.close()
                 continue  # Retry with a new key
 
         except (requests.exceptions.RequestException, SSEPrecheckError) as e:
-            end_time = datetime.now()
-            response_time_ms = int((end_time - start_time).total_seconds() * 1000)
+            response_time_ms = (time.monotonic_ns() - start_time_ns) // 1_000_000
             print(f"Request/SSE error for key {key_id}: {e}")
             update_key_status_in_db(
                 key_id, model_name, 500, source="proxy_service"
@@ -290,8 +374,7 @@ def handle_request(subpath):
             continue  # Retry with a new key
 
         except Exception as e:
-            end_time = datetime.now()
-            response_time_ms = int((end_time - start_time).total_seconds() * 1000)
+            response_time_ms = (time.monotonic_ns() - start_time_ns) // 1_000_000
             print(
                 f"An unexpected error occurred for key {key_id}: {e}\n{traceback.format_exc()}"
             )
@@ -311,4 +394,4 @@ def handle_request(subpath):
 
 
 if __name__ == "__main__":
-    app.run(debug=True, port=52948)
+    app.run(debug=True, port=52948, threaded=True)
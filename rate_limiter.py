@@ -1,6 +1,6 @@
+import threading
 import time
 import database
-from datetime import datetime
 
 class RateLimiter:
     def __init__(self, tpm_limit=40, ban_limit=3600, ban_duration=3600):
@@ -8,40 +8,52 @@ class RateLimiter:
         self.ban_limit = ban_limit  # Requests per hour for permanent ban
         self.ban_duration = ban_duration # Ban duration in seconds (1 hour)
 
-        self.ip_requests_minute = {}  # {ip: [(timestamp, count)]}
-        self.ip_requests_hour = {}    # {ip: [(timestamp, count)]}
+        # Fixed-window counters: {ip: [minute_start, minute_count, hour_start, hour_count]}
+        self.ip_counters = {}
+        self._lock = threading.Lock()  # Flask serves requests from several threads
+        self._next_cleanup = time.time() + 3600
         
-        # Explicitly initialize as a dictionary to help the linter
-        self.banned_ips = {} 
-        self.banned_ips.update(database.get_all_banned_ips())
+        # Only membership is checked on the request path, so a plain set is enough
+        self.banned_ips = set(database.get_all_banned_ip_set())
 
-    def _clean_old_requests(self, ip, request_dict, time_window):
-        current_time = time.time()
-        # Remove requests older than time_window
-        request_dict[ip] = [(t, c) for t, c in request_dict.get(ip, []) if current_time - t < time_window]
+    def _remove_idle_ips(self, current_time):
+        # Drop IPs whose hour window has expired; their counters would be reset anyway
+        self.ip_counters = {
+            ip: counter for ip, counter in self.ip_counters.items()
+            if current_time - counter[2] < 3600
+        }
+        self._next_cleanup = current_time + 3600
 
     def check_rate_limit(self, ip):
         current_time = time.time()
 
-        # Check if IP is permanently banned
-        if ip in self.banned_ips:
+        # Check if IP is permanently banned, here or by another worker process.
+        # The shared set is cached by the database layer, so this rarely queries.
+        if ip in self.banned_ips or ip in database.get_all_banned_ip_set():
             return False
 
-        # Clean old requests for minute and hour windows
-        self._clean_old_requests(ip, self.ip_requests_minute, 60)
-        self._clean_old_requests(ip, self.ip_requests_hour, 3600)
+        with self._lock:
+            counter = self.ip_counters.get(ip)
+            if counter is None:
+                counter = self.ip_counters[ip] = [current_time, 0, current_time, 0]
+
+            # Start a new window once the minute or hour has elapsed
+            if current_time - counter[0] >= 60:
+                counter[0], counter[1] = current_time, 0
+            if current_time - counter[2] >= 3600:
+                counter[2], counter[3] = current_time, 0
 
-        # Update request count for the current minute
-        self.ip_requests_minute.setdefault(ip, []).append((current_time, 1))
-        current_minute_requests = sum(count for _, count in self.ip_requests_minute[ip])
+            counter[1] += 1
+            counter[3] += 1
+            current_minute_requests = counter[1]
+            current_hour_requests = counter[3]
 
-        # Update request count for the current hour
-        self.ip_requests_hour.setdefault(ip, []).append((current_time, 1))
-        current_hour_requests = sum(count for _, count in self.ip_requests_hour[ip])
+            if current_time >= self._next_cleanup:
+                self._remove_idle_ips(current_time)
 
         # Check for permanent ban
         if current_hour_requests > self.ban_limit:
-            self.banned_ips[ip] = datetime.now() # Assign to dict
+            self.banned_ips.add(ip)
             database.add_banned_ip(ip)  # Persist the ban to the database
             return False
 
@@ -0,0 +1,65 @@
+import threading
+import time
+import config
+from database import cleanup_old_logs
+from key_sync import sync_keys_to_db
+from key_status_printer import print_key_status
+
+
+class PeriodicJob:
+    """A function that should run every `interval_seconds`."""
+
+    def __init__(self, func, interval_seconds):
+        self.func = func
+        self.interval_seconds = interval_seconds
+        self.next_run = time.monotonic()
+
+
+class Scheduler:
+    """
+    Runs periodic jobs one at a time on a single background thread.
+    Runs missed while another job was busy are coalesced into one, so a slow
+    job never triggers a burst of catch-up runs.
+    """
+
+    def __init__(self):
+        self.jobs = []
+        self._thread = None
+
+    def add_job(self, func, interval_seconds):
+        """Registers `func` to run now and then every `interval_seconds`."""
+        self.jobs.append(PeriodicJob(func, interval_seconds))
+
+    def run_forever(self):
+        while True:
+            job = min(self.jobs, key=lambda j: j.next_run)
+            delay = job.next_run - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+            try:
+                job.func()
+            except Exception as e:
+                print(f"Scheduled job {job.func.__name__} failed: {e}")
+
+            # Keep a fixed rate, but if the next slot has already passed,
+            # run once as soon as possible instead of replaying every slot
+            job.next_run = max(job.next_run + job.interval_seconds, time.monotonic())
+
+    def start(self):
+        """Starts the scheduler loop in a daemon thread."""
+        self._thread = threading.Thread(target=self.run_forever, daemon=True)
+        self._thread.start()
+
+
+def create_scheduler():
+    """Builds the scheduler for the periodic background jobs."""
+    scheduler = Scheduler()
+    scheduler.add_job(sync_keys_to_db, config.KEY_SYNC_INTERVAL_SECONDS)
+    scheduler.add_job(print_key_status, config.KEY_STATUS_PRINTER_INTERVAL_SECONDS)
+    scheduler.add_job(cleanup_old_logs, config.LOG_CLEANER_INTERVAL_SECONDS)
+    return scheduler
+
+
+if __name__ == "__main__":
+    create_scheduler().run_forever()